@@ -1,15 +1,31 @@
 # app.py
 import os
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
 import json
+import hashlib
 import re
+import threading
+import time
+import zlib
 from io import BytesIO
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 from dotenv import load_dotenv
+import diskcache
+import httpx
+import orjson
 import streamlit as st
-from fpdf import FPDF
-from openai import OpenAI
+from fpdf import FPDF, XPos, YPos
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, OpenAI, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 from unidecode import unidecode   # transliterate unicode -> ascii (avoids latin-1 issues)
 
+# Must be the first Streamlit command: the cached resources below show a spinner (an element)
+# the first time they are created
+st.set_page_config(page_title="OpenAI Notes & Quiz (gpt-4o)", layout="wide")
+
 # -----------------------
 # Config
 # -----------------------
@@ -57,31 +73,156 @@ if not OPENAI_API_KEY:
     )
     st.stop()
 
-# create client
-client = OpenAI(api_key=OPENAI_API_KEY)
+# create clients (async one is used for concurrent fan-out, e.g. DALL-E images)
+# Both are cached across reruns and sessions so their connection pools (and TLS sessions) are
+# reused. Retries are done by api_retry below, so the SDK's own retry loop is disabled.
+# The timeout leaves room for the longest non-streamed completion (references, ~2000 tokens).
+@st.cache_resource
+def get_client(api_key: str) -> OpenAI:
+    return OpenAI(api_key=api_key, max_retries=0, timeout=120.0)
+
+@st.cache_resource
+def get_aclient(api_key: str) -> AsyncOpenAI:
+    return AsyncOpenAI(api_key=api_key, max_retries=0, timeout=120.0)
+
+client = get_client(OPENAI_API_KEY)
+aclient = get_aclient(OPENAI_API_KEY)
+
+
+@st.cache_resource
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Event loop running in a background thread, shared by all sessions and reruns."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="openai-async", daemon=True).start()
+    return loop
+
+def submit_async(coro) -> concurrent.futures.Future:
+    """Start a coroutine on the background loop without waiting for it."""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+
+def run_async(coro):
+    """Run a coroutine to completion from synchronous Streamlit code."""
+    return submit_async(coro).result()
+
+# Response cache: identical requests (same prompt, input, settings and model) are served from
+# disk instead of the API, across reruns, sessions and restarts.
+CACHE_DIR = os.getenv("OPENAI_CACHE_DIR", ".cache/openai")
+CACHE_TTL = 3600
+IMAGE_CACHE_TTL = 50 * 60  # DALL-E image URLs expire after an hour
+
+@st.cache_resource
+def get_response_cache() -> diskcache.Cache:
+    return diskcache.Cache(CACHE_DIR)
+
+response_cache = get_response_cache()
+
+def cache_key(*parts) -> str:
+    """Deterministic cache key for an API request."""
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+def _cache_get(key: str, refresh: bool = False):
+    """Cached result for key, or None on a miss. refresh=True skips the lookup, so the new
+    result overwrites the old one."""
+    return None if refresh else response_cache.get(key)
+
+def _cache_put(key: str, value: str, ttl: int = CACHE_TTL):
+    """Cache a successful result; empty results are not stored."""
+    if value:
+        response_cache.set(key, value, expire=ttl)
+
+# Rate limits: transient failures (429, dropped connections, 5xx) are retried with jittered
+# exponential backoff, and concurrent fan-out is throttled client-side to stay inside the
+# account's limits (the openai-cookbook api_request_parallel_processor approach).
+MAX_CONCURRENT_REQUESTS = int(os.getenv("OPENAI_MAX_CONCURRENCY", "10"))
+TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TPM_LIMIT", "30000"))
+
+api_retry = retry(
+    wait=wait_exponential_jitter(initial=1, max=30),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, InternalServerError)),
+    reraise=True,
+)
+
+class RequestBudget:
+    """
+    Limits async requests to `max_concurrent` in flight and about `tokens_per_minute`
+    estimated tokens per sliding 60s window; requests over budget wait for the window to move.
+    """
+
+    def __init__(self, max_concurrent: int, tokens_per_minute: int):
+        self.tokens_per_minute = tokens_per_minute
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.lock = asyncio.Lock()
+        self.window = collections.deque()  # (timestamp, tokens) of recent requests
+
+    async def _reserve(self, tokens: int):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                while self.window and now - self.window[0][0] >= 60:
+                    self.window.popleft()
+                used = sum(t for _, t in self.window)
+                # a single request larger than the budget still goes through once the window is empty
+                if not self.window or used + tokens <= self.tokens_per_minute:
+                    self.window.append((now, tokens))
+                    return
+                await asyncio.sleep(60 - (now - self.window[0][0]))
+
+    @contextlib.asynccontextmanager
+    async def slot(self, tokens: int = 0):
+        await self._reserve(tokens)
+        async with self.semaphore:
+            yield
+
+@st.cache_resource
+def get_request_budget() -> RequestBudget:
+    return RequestBudget(MAX_CONCURRENT_REQUESTS, TOKENS_PER_MINUTE)
+
+request_budget = get_request_budget()
+
+@api_retry
+def _create_response(**request):
+    return client.responses.create(**request)
+
+@api_retry
+async def _acreate_response(**request):
+    # rough estimate: ~4 characters per prompt token, plus the whole output allowance
+    tokens = (len(request.get("instructions", "")) + len(request.get("input", ""))) // 4 + request.get("max_output_tokens", 0)
+    async with request_budget.slot(tokens):
+        return await aclient.responses.create(**request)
+
+@api_retry
+async def _agenerate_image(**request):
+    async with request_budget.slot():
+        return await aclient.images.generate(**request)
 # ---------------------------------------------------------------------------------------
 
 # -----------------------
 # DALL-E Image Generation
 # -----------------------
-def generate_image_with_dalle(prompt: str, size: str = "1024x1024", quality: str = "standard") -> str:
-    """Generate an image using DALL-E API. Returns image URL or error message."""
+async def generate_image_with_dalle(prompt: str, size: str = "1024x1024", quality: str = "standard", refresh: bool = False) -> str:
+    """Generate an image using DALL-E API. Returns image URL or error message.
+    URLs are cached per prompt; refresh=True always requests a new image."""
+    key = cache_key("dall-e-3", prompt, size, quality)
+    cached = _cache_get(key, refresh)
+    if cached is not None:
+        return cached
     try:
-        response = client.images.generate(
+        response = await _agenerate_image(
             model="dall-e-3",
             prompt=prompt,
             size=size,
             quality=quality,
             n=1,
         )
-        return response.data[0].url
+        image_url = response.data[0].url
     except Exception as e:
         return f"Error generating image: {str(e)}"
+    _cache_put(key, image_url, IMAGE_CACHE_TTL)
+    return image_url
 
-def generate_multiple_images_with_dalle(topic: str, num_images: int = 3, context: str = "") -> List[str]:
-    """Generate multiple images for different aspects of a topic."""
-    image_urls = []
-    
+def image_prompts_for_topic(topic: str, num_images: int = 3, context: str = "") -> List[str]:
+    """Build one DALL-E prompt per aspect of a topic (at most 5)."""
     # Create different prompts for different aspects
     aspects = [
         f"Overview diagram for {topic}",
@@ -90,78 +231,106 @@ def generate_multiple_images_with_dalle(topic: str, num_images: int = 3, context
         f"Examples and applications of {topic}",
         f"Advanced topics in {topic}"
     ]
-    
-    for i in range(min(num_images, len(aspects))):
-        prompt = create_image_prompt_from_topic(aspects[i], context)
-        image_url = generate_image_with_dalle(prompt)
+    return [create_image_prompt_from_topic(aspect, context) for aspect in aspects[:num_images]]
+
+async def generate_images_concurrently(prompts: List[str], refresh: bool = False) -> List[str]:
+    """Fire all DALL-E requests at once. Returns URLs or error messages, in prompt order."""
+    results = await asyncio.gather(*[generate_image_with_dalle(p, refresh=refresh) for p in prompts], return_exceptions=True)
+    return [f"Error generating image: {r}" if isinstance(r, BaseException) else r for r in results]
+
+async def fetch_images(urls: List[str]) -> List[Optional[bytes]]:
+    """Download images concurrently. Returns bytes (or None if a download failed), in URL order."""
+    async with httpx.AsyncClient(timeout=30.0, follow_redirects=True) as http:
+        async def fetch(url: str) -> Optional[bytes]:
+            try:
+                resp = await http.get(url)
+                resp.raise_for_status()
+                return resp.content
+            except Exception:
+                return None
+        return await asyncio.gather(*[fetch(u) for u in urls])
+
+# Downloaded images are kept once per process, shared by all sessions, instead of a copy in
+# every session's state; the least recently used are dropped first.
+IMAGE_STORE_SIZE = 32
+
+class ImageStore:
+    """Image bytes by URL, bounded to `max_items` (least recently used evicted)."""
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict()
+
+    def get(self, url: str) -> Optional[bytes]:
+        with self.lock:
+            data = self.items.get(url)
+            if data is not None:
+                self.items.move_to_end(url)
+            return data
+
+    def put(self, url: str, data: bytes):
+        with self.lock:
+            self.items[url] = data
+            self.items.move_to_end(url)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+@st.cache_resource
+def get_image_store() -> ImageStore:
+    return ImageStore(IMAGE_STORE_SIZE)
+
+image_store = get_image_store()
+
+def get_image_bytes(urls: List[str]) -> List[Optional[bytes]]:
+    """Image bytes for the given URLs, downloading only those not already in the image store."""
+    found = [image_store.get(u) for u in urls]
+    missing = [u for u, data in zip(urls, found) if data is None]
+    if missing:
+        fetched = dict(zip(missing, run_async(fetch_images(missing))))
+        for url, data in fetched.items():
+            if data is not None:
+                image_store.put(url, data)
+        found = [data if data is not None else fetched[u] for u, data in zip(urls, found)]
+    return found
+
+def generate_multiple_images_with_dalle(topic: str, num_images: int = 3, context: str = "", refresh: bool = False) -> Tuple[List[str], List[str]]:
+    """Generate multiple images for different aspects of a topic (requests run concurrently).
+    Returns (image_urls, prompts) for the distinct images that succeeded, warning about each failed one."""
+    prompts = image_prompts_for_topic(topic, num_images, context)
+    results = run_async(generate_images_concurrently(prompts, refresh=refresh))
+    image_urls, used_prompts = [], []
+    for i, (image_url, prompt) in enumerate(zip(results, prompts)):
         if not image_url.startswith("Error"):
-            image_urls.append(image_url)
+            if image_url not in image_urls:
+                image_urls.append(image_url)
+                used_prompts.append(prompt)
         else:
             st.warning(f"Failed to generate image {i+1}: {image_url}")
-    
-    return image_urls
+    return image_urls, used_prompts
 
 
 def extract_table_of_contents(md_text: str) -> str:
-    """Extract and format table of contents from markdown text."""
-    lines = md_text.split('\n')
+    """Extract and format table of contents from markdown text (single pass; non-heading lines are skipped on their first character)."""
     toc_items = []
-    
-    for line in lines:
-        if line.startswith('#'):
-            level = len(line) - len(line.lstrip('#'))
-            title = line.lstrip('# ').strip()
-            if title:
-                indent = "  " * (level - 1)
-                toc_items.append(f"{indent}- {title}")
-    
+    for line in md_text.splitlines():
+        if not line or line[0] != '#':
+            continue
+        level = 1
+        while level < len(line) and line[level] == '#':
+            level += 1
+        title = line[level:].strip()
+        if title:
+            toc_items.append(f"{'  ' * (level - 1)}- {title}")
+
     if toc_items:
         return "## 📋 Table of Contents\n\n" + "\n".join(toc_items) + "\n\n---\n\n"
     return ""
 
-def generate_enhanced_references(topic: str) -> str:
+def generate_enhanced_references(topic: str, refresh: bool = False) -> str:
     """Generate comprehensive references including web links, YouTube videos, and model information."""
-    references_prompt = f"""
-    Generate comprehensive references for the topic: {topic}
-    
-    Include the following categories with specific examples:
-    
-    1. **Academic Resources**
-       - Research papers with DOI links
-       - University course materials
-       - Academic journals and publications
-    
-    2. **YouTube Educational Content**
-       - Specific video recommendations with channel names
-       - Educational series and playlists
-       - Tutorial channels and expert content creators
-    
-    3. **Web Resources**
-       - Official documentation and guides
-       - Interactive tutorials and courses
-       - Community forums and discussion platforms
-    
-    4. **Books and Publications**
-       - Textbooks with ISBN numbers
-       - E-books and online publications
-       - Industry reports and white papers
-    
-    5. **Tools and Software**
-       - Relevant software applications
-       - Online tools and platforms
-       - Development environments and frameworks
-    
-    6. **Professional Development**
-       - Certification programs
-       - Online courses and MOOCs
-       - Professional associations and communities
-    
-    Format as a structured markdown list with descriptions and links where applicable.
-    Focus on high-quality, authoritative sources that would be valuable for learning this topic.
-    """
-    
     try:
-        references = call_openai(references_prompt, user_input=topic, temperature=0.3, max_output_tokens=2000)
+        references = call_openai(REFS_PROMPT, user_input=topic, temperature=0.3, max_output_tokens=2000, refresh=refresh)
         return references if not references.startswith("__ERROR__") else "Error generating references"
     except Exception as e:
         return f"Error generating references: {str(e)}"
@@ -182,33 +351,103 @@ def create_image_prompt_from_topic(topic: str, context: str = "") -> str:
 # -----------------------
 # OpenAI wrapper (Responses API)
 # -----------------------
-def call_openai(instructions: str, user_input: str = "", temperature: float = 0.0, max_output_tokens: int = 1400) -> str:
-    """Call Responses API. Returns text or '__ERROR__:' prefix on exception."""
+def _response_text(resp) -> str:
+    """Extract the text from a Responses API result."""
+    # Prefer high-level output_text if present
+    if hasattr(resp, "output_text") and resp.output_text:
+        return resp.output_text.strip()
+    # Fallback: assemble from resp.output (resp may also be a plain dict, e.g. a Batch API result body)
+    parts = []
+    output = resp.get("output") if isinstance(resp, dict) else getattr(resp, "output", [])
+    for item in output or []:
+        if isinstance(item, dict):
+            content = item.get("content")
+            if isinstance(content, list):
+                for c in content:
+                    if isinstance(c, dict) and c.get("type") == "output_text":
+                        parts.append(c.get("text", ""))
+            elif isinstance(content, str):
+                parts.append(content)
+    return "\n".join(parts).strip()
+
+def call_openai(instructions: str, user_input: str = "", temperature: float = 0.0, max_output_tokens: int = 1400, text_format: Optional[Dict] = None, refresh: bool = False) -> str:
+    """Call Responses API. Returns text or '__ERROR__:' prefix on exception.
+    text_format constrains the output (e.g. a JSON schema); see QUIZ_FORMAT.
+    Results are cached by (prompt, input, settings, model); see _cache_get."""
+    key = cache_key(MODEL_NAME, instructions, user_input, temperature, max_output_tokens, text_format)
+    cached = _cache_get(key, refresh)
+    if cached is not None:
+        return cached
     try:
-        resp = client.responses.create(
+        resp = _create_response(
             model=MODEL_NAME,
             instructions=instructions,
             input=user_input,
             temperature=temperature,
             max_output_tokens=max_output_tokens,
+            **({"text": {"format": text_format}} if text_format else {}),
         )
-        # Prefer high-level output_text if present
-        if hasattr(resp, "output_text") and resp.output_text:
-            return resp.output_text.strip()
-        # Fallback: assemble from resp.output
-        parts = []
-        for item in getattr(resp, "output", []) or []:
-            if isinstance(item, dict):
-                content = item.get("content")
-                if isinstance(content, list):
-                    for c in content:
-                        if isinstance(c, dict) and c.get("type") == "output_text":
-                            parts.append(c.get("text", ""))
-                elif isinstance(content, str):
-                    parts.append(content)
-        return "\n".join(parts).strip()
+        text = _response_text(resp)
     except Exception as exc:
         return f"__ERROR__:{exc}"
+    _cache_put(key, text)
+    return text
+
+async def acall_openai(instructions: str, user_input: str = "", temperature: float = 0.0, max_output_tokens: int = 1400, text_format: Optional[Dict] = None, refresh: bool = False) -> str:
+    """Async variant of call_openai, used to run independent requests concurrently."""
+    key = cache_key(MODEL_NAME, instructions, user_input, temperature, max_output_tokens, text_format)
+    cached = _cache_get(key, refresh)
+    if cached is not None:
+        return cached
+    try:
+        resp = await _acreate_response(
+            model=MODEL_NAME,
+            instructions=instructions,
+            input=user_input,
+            temperature=temperature,
+            max_output_tokens=max_output_tokens,
+            **({"text": {"format": text_format}} if text_format else {}),
+        )
+        text = _response_text(resp)
+    except Exception as exc:
+        return f"__ERROR__:{exc}"
+    _cache_put(key, text)
+    return text
+
+def stream_openai(instructions: str, user_input: str = "", temperature: float = 0.0, max_output_tokens: int = 1400):
+    """Yield Responses API text deltas as they arrive (for st.write_stream). Raises on API errors.
+    Shares call_openai's cache: a cached result is yielded in one piece."""
+    key = cache_key(MODEL_NAME, instructions, user_input, temperature, max_output_tokens, None)
+    cached = _cache_get(key)
+    if cached is not None:
+        yield cached
+        return
+    parts = []
+    completed = False
+    # only opening the stream is retried; deltas already shown cannot be replayed
+    with _create_response(
+        model=MODEL_NAME,
+        instructions=instructions,
+        input=user_input,
+        temperature=temperature,
+        max_output_tokens=max_output_tokens,
+        stream=True,
+    ) as stream:
+        for event in stream:
+            if event.type == "response.output_text.delta":
+                parts.append(event.delta)
+                yield event.delta
+            elif event.type == "response.completed":
+                completed = True
+            # the SDK does not raise on these, so a failed stream would otherwise just end
+            elif event.type == "response.failed":
+                error = event.response.error
+                raise RuntimeError(error.message if error else "response failed")
+            elif event.type == "error":
+                raise RuntimeError(event.message)
+    # cached exactly as st.write_stream joins it, and only once the response is complete
+    if completed:
+        _cache_put(key, "".join(parts))
 
 # -----------------------
 # Prompts
@@ -261,308 +500,667 @@ QUIZ_PROMPT = (
     "- Exactly 4 options per question.\n"
     "- Include a 'difficulty' field with values 'Easy','Medium','Hard'.\n"
     "- Use this exact JSON form (answer is zero-based index):\n"
-    "[\n"
+    "{\"questions\": [\n"
     "  {\"question\":\"...\",\"options\":[\"optA\",\"optB\",\"optC\",\"optD\"], \"answer\": 0, \"difficulty\":\"Easy\"},\n"
     "  ...  (10 items total)\n"
-    "]\n"
+    "]}\n"
     "Split difficulties: 4 Easy, 3 Medium, 3 Hard (any order). DO NOT output any commentary outside the JSON. Topic:"
 )
 
+# Structured output for the quiz: the API only returns JSON matching this schema.
+QUIZ_FORMAT = {
+    "type": "json_schema",
+    "name": "quiz",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "questions": {
+                "type": "array",
+                "minItems": 10,
+                "maxItems": 10,
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "question": {"type": "string"},
+                        "options": {"type": "array", "items": {"type": "string"}, "minItems": 4, "maxItems": 4},
+                        "answer": {"type": "integer", "minimum": 0, "maximum": 3},
+                        "difficulty": {"type": "string", "enum": ["Easy", "Medium", "Hard"]},
+                    },
+                    "required": ["question", "options", "answer", "difficulty"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["questions"],
+        "additionalProperties": False,
+    },
+}
+
+REFS_PROMPT = """
+Generate comprehensive references for the given Topic.
+
+Include the following categories with specific examples:
+
+1. **Academic Resources**
+   - Research papers with DOI links
+   - University course materials
+   - Academic journals and publications
+
+2. **YouTube Educational Content**
+   - Specific video recommendations with channel names
+   - Educational series and playlists
+   - Tutorial channels and expert content creators
+
+3. **Web Resources**
+   - Official documentation and guides
+   - Interactive tutorials and courses
+   - Community forums and discussion platforms
+
+4. **Books and Publications**
+   - Textbooks with ISBN numbers
+   - E-books and online publications
+   - Industry reports and white papers
+
+5. **Tools and Software**
+   - Relevant software applications
+   - Online tools and platforms
+   - Development environments and frameworks
+
+6. **Professional Development**
+   - Certification programs
+   - Online courses and MOOCs
+   - Professional associations and communities
+
+Format as a structured markdown list with descriptions and links where applicable.
+Focus on high-quality, authoritative sources that would be valuable for learning this topic.
+"""
+
 # -----------------------
-# Robust JSON extractor + retry
+# Quiz JSON parsing + retry
 # -----------------------
 def extract_json(text: str):
-    """Try multiple ways to parse JSON from model output."""
+    """Parse JSON from model output (the quiz is requested as structured output, so it is valid JSON)."""
     if not text:
         raise ValueError("Empty text")
     if text.startswith("__ERROR__"):
         raise ValueError(text)
-    # Direct
     try:
-        return json.loads(text)
-    except Exception:
-        pass
-    # Between first [ and last ]
-    s = text.find("[")
-    e = text.rfind("]")
-    if s != -1 and e != -1 and e > s:
-        chunk = text[s:e+1]
-        try:
-            return json.loads(chunk)
-        except Exception:
-            pass
-    # Try JSON inside <JSON>...</JSON> tags (if model wrapped)
-    m = re.search(r"<JSON>(.*)</JSON>", text, flags=re.DOTALL)
-    if m:
-        try:
-            return json.loads(m.group(1).strip())
-        except Exception:
-            pass
-    # Try single->double quote sanitize
-    try:
-        cand = text.strip().replace("\n", " ")
-        cand = re.sub(r"(\w)'(\w)", r"\1’\2", cand)
-        cand = cand.replace("'", '"')
-        return json.loads(cand)
-    except Exception as exc:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError as exc:
         raise ValueError("Could not parse JSON from model output: " + str(exc))
 
-def generate_quiz_with_retries(topic: str, attempts: int = 2) -> List[Dict]:
-    """Try to generate & parse quiz JSON with 1-2 attempts, using different instructions if needed."""
-    # first attempt: normal strict prompt
-    prompt = QUIZ_PROMPT
+def parse_quiz(raw: str) -> List[Dict]:
+    """Parse model output into a normalized list of 10 quiz questions. Raises ValueError if invalid."""
+    parsed = extract_json(raw)
+    if isinstance(parsed, dict):
+        parsed = parsed.get("questions")
+    # validate structure
+    if not isinstance(parsed, list) or len(parsed) != 10:
+        raise ValueError("Parsed JSON not length 10")
+    normalized = []
+    for item in parsed:
+        if not isinstance(item, dict):
+            raise ValueError("Invalid item")
+        q = item.get("question")
+        opts = item.get("options")
+        ans = item.get("answer")
+        diff = item.get("difficulty", "Medium")
+        if not q or not isinstance(opts, list) or len(opts) != 4 or ans not in [0,1,2,3]:
+            raise ValueError("Invalid question format")
+        normalized.append({
+            "question": q.strip(),
+            "options": [str(x).strip() for x in opts],
+            "answer": int(ans),
+            "difficulty": diff
+        })
+    return normalized
+
+async def generate_quiz_with_retries(topic: str, attempts: int = 2) -> List[Dict]:
+    """Generate & parse the quiz as structured output; a retry is only needed if validation fails."""
     for i in range(attempts):
-        raw = call_openai(prompt, user_input=topic, temperature=0.0, max_output_tokens=1400)
+        # a retry must not be served the cached output that just failed
+        raw = await acall_openai(QUIZ_PROMPT, user_input=topic, temperature=0.0, max_output_tokens=1400,
+                                 text_format=QUIZ_FORMAT, refresh=i > 0)
         try:
-            parsed = extract_json(raw)
-            # validate structure
-            if not isinstance(parsed, list) or len(parsed) != 10:
-                raise ValueError("Parsed JSON not length 10")
-            normalized = []
-            for item in parsed:
-                if not isinstance(item, dict):
-                    raise ValueError("Invalid item")
-                q = item.get("question")
-                opts = item.get("options")
-                ans = item.get("answer")
-                diff = item.get("difficulty", "Medium")
-                if not q or not isinstance(opts, list) or len(opts) != 4 or ans not in [0,1,2,3]:
-                    raise ValueError("Invalid question format")
-                normalized.append({
-                    "question": q.strip(),
-                    "options": [str(x).strip() for x in opts],
-                    "answer": int(ans),
-                    "difficulty": diff
-                })
-            return normalized
-        except Exception as e:
-            # second attempt: ask model to wrap JSON with <JSON>...</JSON> and nothing else
-            if i == 0:
-                prompt = "IMPORTANT: Output ONLY the JSON array. If you add comments, wrap the JSON inside <JSON> ... </JSON> tags. " + QUIZ_PROMPT
+            return parse_quiz(raw)
+        except Exception:
+            if i + 1 < attempts:
                 continue
-            # else fallback to raising and let caller fallback
+            # let caller fallback
             raise
 
+# -----------------------
+# Content pipeline
+# -----------------------
+async def generate_references_and_quiz(topic: str, references: bool = True) -> Dict:
+    """
+    Request references and quiz together; both only depend on the topic, so they can run
+    in the background while the notes stream in.
+    The quiz entry is either the parsed quiz or the exception that made it fail.
+    With references=False (batch mode) only the quiz is requested and references is None.
+    """
+    async def quiz_or_error():
+        try:
+            return await generate_quiz_with_retries(topic, attempts=2)
+        except Exception as exc:
+            return exc
+
+    if not references:
+        return {"references": None, "quiz": await quiz_or_error()}
+    refs, quiz = await asyncio.gather(
+        acall_openai(REFS_PROMPT, user_input=topic, temperature=0.3, max_output_tokens=2000),
+        quiz_or_error(),
+    )
+    return {"references": refs, "quiz": quiz}
+
+# -----------------------
+# Batch API (batch mode: 50% cheaper, results within 24h)
+# -----------------------
+BATCH_POLL_INTERVAL = 30  # seconds between status checks, however often the page reruns
+
+def submit_references_batch(topic: str) -> str:
+    """Queue the references request on the Batch API. Returns the batch id."""
+    request = {
+        "custom_id": "references",
+        "method": "POST",
+        "url": "/v1/responses",
+        "body": {
+            "model": MODEL_NAME,
+            "instructions": REFS_PROMPT,
+            "input": topic,
+            "temperature": 0.3,
+            "max_output_tokens": 2000,
+        },
+    }
+    batch_file = client.files.create(file=("references.jsonl", (json.dumps(request) + "\n").encode("utf-8")), purpose="batch")
+    batch = client.batches.create(input_file_id=batch_file.id, endpoint="/v1/responses", completion_window="24h")
+    return batch.id
+
+def poll_references_batch(batch_id: str, topic: str) -> Optional[str]:
+    """
+    Check a references batch. Returns None while it is still running, the references text once
+    it has completed (also stored in the response cache), or an '__ERROR__:' string.
+    """
+    batch = client.batches.retrieve(batch_id)
+    if batch.status in ("validating", "in_progress", "finalizing"):
+        return None
+    if batch.status != "completed" or not batch.output_file_id:
+        return f"__ERROR__:batch {batch.status}"
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        result = json.loads(line)
+        response = result.get("response") or {}
+        if result.get("custom_id") != "references" or response.get("status_code") != 200:
+            continue
+        text = _response_text(response.get("body") or {})
+        if text:
+            # same key call_openai uses, so later interactive requests for this topic are cache hits
+            _cache_put(cache_key(MODEL_NAME, REFS_PROMPT, topic, 0.3, 2000, None), text)
+            return text
+    return "__ERROR__:batch returned no references"
+
 # -----------------------
 # PDF helpers (using fpdf, but transliterate unicode -> ascii with unidecode)
 # -----------------------
-def markdown_to_pdf_with_images(md_text: str, title: str = "Study Notes", image_urls: List[str] = None) -> BytesIO:
-    """Convert markdown to PDF with embedded images."""
-    # sanitize: transliterate unicode to ascii
-    safe_text = unidecode(md_text)
+# Line patterns, compiled once instead of on every line of every document
+_BULLET_RE = re.compile(r"^\s*([-*])\s+")
+_NUM_RE = re.compile(r"^\s*\d+\.\s+")
+_BOLD_RE = re.compile(r"^\*\*(.+)\*\*$")
 
-    pdf = FPDF()
-    pdf.set_auto_page_break(auto=True, margin=15)
-    pdf.add_page()
+# fpdf2 leaves the cursor right of a cell by default; every call here continues on the next line
+_NEXT_LINE = {"new_x": XPos.LMARGIN, "new_y": YPos.NEXT}
 
-    # Title
-    pdf.set_font("Arial", "B", 16)
-    pdf.cell(0, 10, title, ln=True)
-    pdf.ln(4)
+# Quiz option labels by answer index
+_OPTION_LABELS = ("A", "B", "C", "D")
 
-    in_code = False
-    image_count = 0
-    
-    for raw in safe_text.splitlines():
+def to_ascii(text: str) -> str:
+    """
+    Transliterate text to ASCII with unidecode, line by line.
+    Lines that are already ASCII (most of a typical document) skip the per-character
+    Python lookup entirely; str.isascii is a single C-level scan.
+    """
+    if text.isascii():
+        return text
+    return "\n".join(line if line.isascii() else unidecode(line) for line in text.split("\n"))
+
+def markdown_blocks(md_text: str) -> List[tuple]:
+    """
+    Split markdown into (kind, text) blocks in one pass, for the PDF renderers below.
+    kind is one of: code, h1, h2, h3, bold, bullet, numbered, blank, para.
+    Runs of plain lines and whole code blocks become a single newline-joined block,
+    so each is laid out by one multi_cell call instead of one call per line.
+    """
+    blocks = []
+    para = []
+    code = None  # lines of the open code block
+
+    for raw in md_text.splitlines():
         line = raw.rstrip()
+        # Dispatch on the first non-blank character, so plain text lines (the common case)
+        # skip the prefix and regex tests below
+        c = line[:1]
+        if c == " " or c == "\t":
+            c = line.lstrip()[:1]
 
         # code fence
-        if line.strip().startswith("```"):
-            if not in_code:
-                in_code = True
-                pdf.set_font("Courier", size=9)
-                pdf.ln(2)
-                continue
+        if c == "`" and line.lstrip().startswith("```"):
+            if code is None:
+                if para:
+                    blocks.append(("para", "\n".join(para)))
+                    para = []
+                code = []
             else:
-                in_code = False
-                pdf.set_font("Arial", size=11)
-                pdf.ln(2)
-                continue
-
-        if in_code:
-            pdf.multi_cell(0, 6, line)
+                blocks.append(("code", "\n".join(code)))
+                code = None
             continue
 
-        # headers
-        if line.startswith("# "):
-            pdf.set_font("Arial", "B", 16)
-            pdf.cell(0, 8, line[2:], ln=True)
-            continue
-        if line.startswith("## "):
-            pdf.set_font("Arial", "B", 14)
-            pdf.cell(0, 7, line[3:], ln=True)
-            continue
-        if line.startswith("### "):
-            pdf.set_font("Arial", "B", 12)
-            pdf.cell(0, 6, line[4:], ln=True)
+        if code is not None:
+            code.append(line)
             continue
 
-        # bold/italic
-        if line.startswith("**") and line.endswith("**"):
-            pdf.set_font("Arial", "B", 11)
-            pdf.cell(0, 6, line[2:-2], ln=True)
+        if not c:
+            kind = "blank"
+        elif c == "#" and line.startswith("# "):
+            kind = "h1"
+        elif c == "#" and line.startswith("## "):
+            kind = "h2"
+        elif c == "#" and line.startswith("### "):
+            kind = "h3"
+        elif c == "*" and _BOLD_RE.match(line):
+            kind = "bold"
+        elif (c == "-" or c == "*") and _BULLET_RE.match(line):
+            kind = "bullet"
+        elif c.isdigit() and _NUM_RE.match(line):
+            kind = "numbered"
+        else:
+            para.append(line)
             continue
 
-        # lists
-        if re.match(r"^\s*([-*])\s+", line):
-            bullet = re.sub(r"^\s*([-*])\s+", "- ", line)
-            pdf.multi_cell(0, 6, bullet)
-            continue
+        if para:
+            blocks.append(("para", "\n".join(para)))
+            para = []
+        blocks.append((kind, line))
 
-        # numbered lists
-        if re.match(r"^\s*\d+\.\s+", line):
-            pdf.multi_cell(0, 6, line)
-            continue
+    if para:
+        blocks.append(("para", "\n".join(para)))
+    if code is not None:
+        # unterminated fence: render the rest as code
+        blocks.append(("code", "\n".join(code)))
+    return blocks
 
-        # normal paragraph
-        if line.strip() == "":
+def output_pdf(pdf: FPDF, path: Optional[str] = None) -> Optional[BytesIO]:
+    """Write a finished document to `path` (returns None), or by default into a rewound BytesIO."""
+    if path:
+        pdf.output(path)
+        return None
+    bio = BytesIO()
+    pdf.output(bio)
+    bio.seek(0)
+    return bio
+
+def markdown_to_pdf_with_images(md_text: str, title: str = "Study Notes", image_urls: List[str] = None,
+                                image_bytes: List[Optional[bytes]] = None, pre_sanitized: bool = False,
+                                path: Optional[str] = None) -> Optional[BytesIO]:
+    """Convert markdown to PDF with embedded images.
+    image_bytes holds the downloaded images (see get_image_bytes); they are fetched here if not given.
+    pre_sanitized=True means md_text is already ASCII (see get_notes_ascii) and is not transliterated again.
+    With `path` the PDF is written to that file instead of being returned."""
+    # sanitize: transliterate unicode to ascii
+    safe_text = md_text if pre_sanitized else to_ascii(md_text)
+
+    pdf = FPDF()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.add_page()
+    # Only switch fonts when the block actually needs a different one
+    cur_font = None
+    def use(family: str, style: str = "", size: int = 11):
+        nonlocal cur_font
+        if cur_font != (family, style, size):
+            pdf.set_font(family, style, size)
+            cur_font = (family, style, size)
+
+    # Title
+    use("Helvetica", "B", 16)
+    pdf.cell(0, 10, title, **_NEXT_LINE)
+    pdf.ln(4)
+
+    for kind, text in markdown_blocks(safe_text):
+        if kind == "code":
+            use("Courier", size=9)
+            pdf.ln(2)
+            if text:
+                pdf.multi_cell(0, 6, text, **_NEXT_LINE)
             pdf.ln(2)
+        # headers
+        elif kind == "h1":
+            use("Helvetica", "B", 16)
+            pdf.cell(0, 8, text[2:], **_NEXT_LINE)
+        elif kind == "h2":
+            use("Helvetica", "B", 14)
+            pdf.cell(0, 7, text[3:], **_NEXT_LINE)
+        elif kind == "h3":
+            use("Helvetica", "B", 12)
+            pdf.cell(0, 6, text[4:], **_NEXT_LINE)
+        # bold/italic
+        elif kind == "bold":
+            use("Helvetica", "B", 11)
+            pdf.cell(0, 6, text[2:-2], **_NEXT_LINE)
+        # lists
+        elif kind == "bullet":
+            use("Helvetica", size=11)
+            bullet = _BULLET_RE.sub("- ", text, count=1)
+            pdf.multi_cell(0, 6, bullet, **_NEXT_LINE)
+        # numbered lists
+        elif kind == "numbered":
+            use("Helvetica", size=11)
+            pdf.multi_cell(0, 6, text, **_NEXT_LINE)
+        elif kind == "blank":
+            pdf.ln(2)
+        # normal paragraph
         else:
-            pdf.set_font("Arial", size=11)
-            pdf.multi_cell(0, 6, line)
+            use("Helvetica", size=11)
+            pdf.multi_cell(0, 6, text, **_NEXT_LINE)
 
     # Add images if available
     if image_urls:
         pdf.add_page()
-        pdf.set_font("Arial", "B", 14)
-        pdf.cell(0, 8, "Generated Educational Images", ln=True)
+        use("Helvetica", "B", 14)
+        pdf.cell(0, 8, "Generated Educational Images", **_NEXT_LINE)
         pdf.ln(4)
         
-        for i, image_url in enumerate(image_urls):
+        if image_bytes is None:
+            image_bytes = run_async(fetch_images(image_urls))
+        use("Helvetica", size=10)
+        for i, data in enumerate(image_bytes):
+            pdf.cell(0, 6, f"Image {i+1}", **_NEXT_LINE)
             try:
-                # Add image placeholder text since we can't embed URLs directly
-                pdf.set_font("Arial", size=10)
-                pdf.cell(0, 6, f"Image {i+1}: {image_url}", ln=True)
-                pdf.ln(2)
+                if data is None:
+                    raise ValueError("download failed")
+                pdf.image(BytesIO(data), w=160)
+                pdf.ln(4)
             except Exception as e:
-                pdf.cell(0, 6, f"Image {i+1}: [Image could not be embedded]", ln=True)
+                pdf.cell(0, 6, "[Image could not be embedded]", **_NEXT_LINE)
 
-    # finalize -- use dest='S' to get bytes (string), then encode latin-1 (safe after unidecode)
-    out_str = pdf.output(dest="S")
-    result_bytes = out_str.encode("latin-1", errors="ignore")
-    bio = BytesIO(result_bytes)
-    bio.seek(0)
-    return bio
+    # finalize -- fpdf2 writes the document straight into the file or buffer
+    return output_pdf(pdf, path)
 
-def markdown_to_pdf_bytes(md_text: str, title: str = "Study Notes") -> BytesIO:
+def markdown_to_pdf_bytes(md_text: str, title: str = "Study Notes", pre_sanitized: bool = False,
+                          path: Optional[str] = None) -> Optional[BytesIO]:
     """
     Simple Markdown-to-PDF using fpdf.
     To avoid latin-1 encoding errors, we first transliterate Unicode to ASCII using unidecode.
     This preserves readability and avoids encoding exceptions reliably.
+    Pass pre_sanitized=True when md_text is already transliterated to skip that pass.
+    With `path` the PDF is written to that file instead of being returned.
     """
     # sanitize: transliterate unicode to ascii
-    safe_text = unidecode(md_text)
+    safe_text = md_text if pre_sanitized else to_ascii(md_text)
 
     pdf = FPDF()
     pdf.set_auto_page_break(auto=True, margin=15)
     pdf.add_page()
+    # Only switch fonts when the block actually needs a different one
+    cur_font = None
+    def use(family: str, style: str = "", size: int = 11):
+        nonlocal cur_font
+        if cur_font != (family, style, size):
+            pdf.set_font(family, style, size)
+            cur_font = (family, style, size)
 
     # Title
-    pdf.set_font("Arial", "B", 16)
-    pdf.cell(0, 10, title, ln=True)
+    use("Helvetica", "B", 16)
+    pdf.cell(0, 10, title, **_NEXT_LINE)
     pdf.ln(4)
 
-    in_code = False
-    for raw in safe_text.splitlines():
-        line = raw.rstrip()
-
-        # code fence
-        if line.strip().startswith("```"):
-            if not in_code:
-                in_code = True
-                pdf.set_font("Courier", size=9)
-                pdf.ln(2)
-                continue
-            else:
-                in_code = False
-                pdf.set_font("Arial", size=11)
-                pdf.ln(2)
-                continue
-
-        if in_code:
-            pdf.set_font("Courier", size=9)
-            pdf.multi_cell(0, 6, line)
-            continue
-
+    for kind, text in markdown_blocks(safe_text):
+        if kind == "code":
+            use("Courier", size=9)
+            pdf.ln(2)
+            if text:
+                pdf.multi_cell(0, 6, text, **_NEXT_LINE)
+            pdf.ln(2)
         # Headings
-        if line.startswith("# "):
-            pdf.set_font("Arial", "B", 14)
-            pdf.multi_cell(0, 8, line.replace("# ", "").strip())
-            pdf.set_font("Arial", size=11)
+        elif kind == "h1":
+            use("Helvetica", "B", 14)
+            pdf.multi_cell(0, 8, text.replace("# ", "").strip(), **_NEXT_LINE)
             pdf.ln(1)
-            continue
-        if line.startswith("## "):
-            pdf.set_font("Arial", "B", 12)
-            pdf.multi_cell(0, 7, line.replace("## ", "").strip())
-            pdf.set_font("Arial", size=11)
-            continue
-        if line.startswith("### "):
-            pdf.set_font("Arial", "B", 11)
-            pdf.multi_cell(0, 6, line.replace("### ", "").strip())
-            pdf.set_font("Arial", size=11)
-            continue
-
+        elif kind == "h2":
+            use("Helvetica", "B", 12)
+            pdf.multi_cell(0, 7, text.replace("## ", "").strip(), **_NEXT_LINE)
+        elif kind == "h3":
+            use("Helvetica", "B", 11)
+            pdf.multi_cell(0, 6, text.replace("### ", "").strip(), **_NEXT_LINE)
         # lists
-        if re.match(r"^\s*([-*])\s+", line):
-            bullet = re.sub(r"^\s*([-*])\s+", "- ", line)
-            pdf.multi_cell(0, 6, bullet)
-            continue
-
+        elif kind == "bullet":
+            use("Helvetica", size=11)
+            bullet = _BULLET_RE.sub("- ", text, count=1)
+            pdf.multi_cell(0, 6, bullet, **_NEXT_LINE)
         # numbered lists
-        if re.match(r"^\s*\d+\.\s+", line):
-            pdf.multi_cell(0, 6, line)
-            continue
-
-        # normal paragraph
-        if line.strip() == "":
+        elif kind == "numbered":
+            use("Helvetica", size=11)
+            pdf.multi_cell(0, 6, text, **_NEXT_LINE)
+        elif kind == "blank":
             pdf.ln(2)
+        # normal paragraph (bold-only lines are plain text here)
         else:
-            pdf.set_font("Arial", size=11)
-            pdf.multi_cell(0, 6, line)
+            use("Helvetica", size=11)
+            pdf.multi_cell(0, 6, text, **_NEXT_LINE)
 
-    # finalize -- use dest='S' to get bytes (string), then encode latin-1 (safe after unidecode)
-    out_str = pdf.output(dest="S")
-    result_bytes = out_str.encode("latin-1", errors="ignore")
-    bio = BytesIO(result_bytes)
-    bio.seek(0)
-    return bio
+    # finalize -- fpdf2 writes the document straight into the file or buffer
+    return output_pdf(pdf, path)
 
-def quiz_pdf_bytes(quiz_list: List[Dict], title: str = "Quiz") -> BytesIO:
+def quiz_pdf_bytes(quiz_list: List[Dict], title: str = "Quiz", path: Optional[str] = None) -> Optional[BytesIO]:
     pdf = FPDF()
     pdf.set_auto_page_break(auto=True, margin=15)
     pdf.add_page()
-    pdf.set_font("Arial", "B", 14)
-    pdf.cell(0, 10, title, ln=True)
+    pdf.set_font("Helvetica", "B", 14)
+    pdf.cell(0, 10, title, **_NEXT_LINE)
     pdf.ln(6)
-    pdf.set_font("Arial", size=12)
+    pdf.set_font("Helvetica", size=12)
     for i, q in enumerate(quiz_list, start=1):
-        pdf.multi_cell(0, 8, f"Q{i}. ({q.get('difficulty','')}) {q['question']}")
-        for idx, opt in enumerate(q.get("options", [])):
-            pdf.multi_cell(0, 8, f"   {chr(65+idx)}) {opt}")
+        # question and its options are laid out by one multi_cell call
+        options = "".join(f"\n   {label}) {opt}" for label, opt in zip(_OPTION_LABELS, q.get("options", [])))
+        pdf.multi_cell(0, 8, f"Q{i}. ({q.get('difficulty','')}) {q['question']}{options}", **_NEXT_LINE)
         pdf.ln(2)
-    out = pdf.output(dest="S").encode("latin-1")
-    return BytesIO(out)
+    return output_pdf(pdf, path)
 
-def answer_key_pdf_bytes(quiz_list: List[Dict], title: str = "Answer Key") -> BytesIO:
+def answer_key_pdf_bytes(quiz_list: List[Dict], title: str = "Answer Key", path: Optional[str] = None) -> Optional[BytesIO]:
     pdf = FPDF()
     pdf.set_auto_page_break(auto=True, margin=15)
     pdf.add_page()
-    pdf.set_font("Arial", "B", 14)
-    pdf.cell(0, 10, title, ln=True)
+    pdf.set_font("Helvetica", "B", 14)
+    pdf.cell(0, 10, title, **_NEXT_LINE)
     pdf.ln(6)
-    pdf.set_font("Arial", size=12)
+    pdf.set_font("Helvetica", size=12)
     for i, q in enumerate(quiz_list, start=1):
         ans_idx = q.get("answer")
-        pdf.multi_cell(0, 8, f"Q{i}. {q['question']}")
-        pdf.multi_cell(0, 8, f"Correct: {chr(65+ans_idx)}) {q['options'][ans_idx]}")
+        pdf.multi_cell(0, 8, f"Q{i}. {q['question']}\nCorrect: {_OPTION_LABELS[ans_idx]}) {q['options'][ans_idx]}", **_NEXT_LINE)
         pdf.ln(2)
-    out = pdf.output(dest="S").encode("latin-1")
-    return BytesIO(out)
+    return output_pdf(pdf, path)
+
+# Prepared PDFs are files under PDF_DIR named by a hash of their inputs, so a build is reused
+# across reruns, sessions and restarts and only repeated if its file is missing. The directory
+# keeps the PDF_CACHE_FILES most recently used files.
+PDF_DIR = os.path.join(CACHE_DIR, "pdf")
+PDF_CACHE_FILES = 64
+
+def prune_pdf_dir():
+    """Delete all but the PDF_CACHE_FILES most recently used PDFs."""
+    try:
+        # in-progress builds (.tmp) are left alone
+        entries = sorted((e for e in os.scandir(PDF_DIR) if e.name.endswith(".pdf")),
+                         key=lambda e: e.stat().st_mtime, reverse=True)
+    except FileNotFoundError:
+        return
+    for entry in entries[PDF_CACHE_FILES:]:
+        with contextlib.suppress(OSError):
+            os.remove(entry.path)
+
+def cached_pdf(build, *key_parts) -> str:
+    """Path of the PDF for key_parts, calling build(path) to write it only if the file does not exist."""
+    path = os.path.join(PDF_DIR, cache_key(*key_parts) + ".pdf")
+    if os.path.exists(path):
+        with contextlib.suppress(OSError):
+            os.utime(path)  # mark as recently used
+        return path
+    os.makedirs(PDF_DIR, exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    try:
+        build(tmp_path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)  # atomic, so a concurrent reader never sees a partial file
+    prune_pdf_dir()
+    return path
+
+def notes_pdf(ascii_md: str, title: str, image_urls: Tuple[str, ...] = ()) -> str:
+    """Notes PDF path; ascii_md is the transliterated notes, as returned by get_notes_ascii.
+    Images are keyed by URL and only downloaded when the PDF has to be built."""
+    def build(path: str):
+        if image_urls:
+            urls = list(image_urls)
+            markdown_to_pdf_with_images(ascii_md, title=title, image_urls=urls, image_bytes=get_image_bytes(urls),
+                                        pre_sanitized=True, path=path)
+        else:
+            markdown_to_pdf_bytes(ascii_md, title=title, pre_sanitized=True, path=path)
+    return cached_pdf(build, "notes", ascii_md, title, image_urls)
+
+def quiz_pdfs(quiz_list: List[Dict], topic: str) -> Tuple[str, str]:
+    """Paths of the quiz and answer-key PDFs."""
+    key = [(q['question'], q['options'], q['answer'], q.get('difficulty', '')) for q in quiz_list]
+    return (cached_pdf(lambda path: quiz_pdf_bytes(quiz_list, title=f"Quiz: {topic}", path=path), "quiz", key, topic),
+            cached_pdf(lambda path: answer_key_pdf_bytes(quiz_list, title=f"Answer Key: {topic}", path=path), "answer_key", key, topic))
+
+# PDFs are built on worker threads: the page keeps rendering while a build runs, and the
+# script waits for it only at the very end (see the bottom of the UI).
+@st.cache_resource
+def get_pdf_executor() -> concurrent.futures.ThreadPoolExecutor:
+    return concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="pdf")
+
+pdf_executor = get_pdf_executor()
+
+def collect_pdf(name: str) -> bool:
+    """Move a finished background build from st.session_state[name + '_future'] to st.session_state[name].
+    Returns True while the build is still running."""
+    future = st.session_state.get(f"{name}_future")
+    if future is None:
+        return False
+    if not future.done():
+        return True
+    del st.session_state[f"{name}_future"]
+    try:
+        st.session_state[name] = future.result()
+    except Exception as e:
+        st.error(f"❌ PDF generation failed: {e}")
+    return False
+
+def pdf_download_button(label: str, path: str, file_name: str) -> bool:
+    """Download button that reads a prepared PDF straight from its file.
+    Returns False (showing nothing) if the file has since been pruned."""
+    try:
+        with open(path, "rb") as f:
+            st.download_button(label, f, file_name=file_name, mime="application/pdf")
+    except FileNotFoundError:
+        return False
+    return True
+
+# Notes are rendered once and then only read back for the TOC, the PDF and the fallback quiz,
+# so session state keeps them zlib-compressed instead of holding the full markdown per session.
+# The ASCII copy the PDF needs is transliterated once here, and only stored if it differs.
+def put_notes(md: str):
+    st.session_state['notes_z'] = zlib.compress(md.encode("utf-8"))
+    ascii_md = to_ascii(md)
+    if ascii_md != md:
+        st.session_state['notes_ascii_z'] = zlib.compress(ascii_md.encode("ascii"))
+    else:
+        st.session_state.pop('notes_ascii_z', None)
+
+def get_notes() -> str:
+    return zlib.decompress(st.session_state['notes_z']).decode("utf-8")
+
+def get_notes_ascii() -> str:
+    if 'notes_ascii_z' in st.session_state:
+        return zlib.decompress(st.session_state['notes_ascii_z']).decode("ascii")
+    return get_notes()
+
+# Quiz difficulty groups, in display order
+QUIZ_ORDER = ("Easy", "Medium", "Hard")
+QUIZ_PLACEHOLDER = "— Select an option —"
+
+def set_quiz(quiz_list: List[Dict]):
+    """Store a new quiz along with everything derived from it, so reruns only read it."""
+    for q in quiz_list:
+        q['_opt_idx'] = {o: i for i, o in enumerate(q['options'])}
+        q['_opts_pl'] = (QUIZ_PLACEHOLDER, *q['options'])
+    st.session_state['quiz'] = quiz_list
+    st.session_state['quiz_correct'] = tuple(q['answer'] for q in quiz_list)
+    # unknown difficulties are shown with the Medium questions rather than dropped
+    grouped = {k: [] for k in QUIZ_ORDER}
+    for i, q in enumerate(quiz_list):
+        diff = q.get('difficulty')
+        grouped[diff if diff in grouped else 'Medium'].append(i)
+    st.session_state['quiz_grouped'] = grouped
+    st.session_state['active_diff'] = next((d for d in QUIZ_ORDER if grouped[d]), 'Medium')
+    st.session_state['answers'] = [None] * len(quiz_list)
+    st.session_state['answered_count'] = 0
+    st.session_state['show_key'] = False
+    st.session_state.pop('quiz_result', None)
+
+def reset_quiz():
+    """Button callback: clear the answers and radio selections so the quiz can be taken again."""
+    quiz_list = st.session_state['quiz']
+    st.session_state['answers'] = [None] * len(quiz_list)
+    st.session_state['answered_count'] = 0
+    st.session_state['show_key'] = False
+    st.session_state['quiz_submitted'] = False
+    st.session_state.pop('quiz_result', None)
+    st.session_state.pop('quiz_pdfs', None)
+    st.session_state.pop('quiz_pdfs_future', None)
+    for i in range(len(quiz_list)):
+        st.session_state.pop(f"q_{i}", None)
+    st.toast("Quiz reset! You can now take it again.")
+
+def switch_difficulty(diff: str):
+    """Form button callback: save the shown difficulty's selections, then show another one."""
+    ss = st.session_state
+    quiz, answers = ss['quiz'], ss['answers']
+    for idx in ss['quiz_grouped'][ss['active_diff']]:
+        sel_idx = quiz[idx]['_opt_idx'].get(ss.get(f"q_{idx}"))
+        ss['answered_count'] += (sel_idx is not None) - (answers[idx] is not None)
+        answers[idx] = sel_idx
+    ss.pop('quiz_result', None)
+    ss['active_diff'] = diff
+
+# Performance feedback by score decile (index: min(int(percentage) // 10, 10))
+_FEEDBACK = (
+    [(st.error, "📚 More study needed. Review the material and try again.")] * 6
+    + [(st.warning, "📖 Keep studying! Focus on the areas you missed.")]
+    + [(st.warning, "📚 Good effort! Review the incorrect answers to improve.")]
+    + [(st.success, "👍 Great job! You have a solid understanding.")]
+    + [(st.success, "🌟 Excellent work! You've mastered this topic!")] * 2
+)
+
+# One answer-key entry per question
+_LINE_TPL = "Q{n}. ({d}) {q}\nCorrect: {cl}) {co}\nYour answer: {ul}) {uo}\n{ok}\n"
+
+def score_quiz(quiz_list: List[Dict], answers: List[Optional[int]], correct: Tuple[int, ...]) -> Dict:
+    """Score the answers against the precomputed correct indices and build the answer-key text."""
+    mask = [user_idx == correct_idx for user_idx, correct_idx in zip(answers, correct)]
+    score = sum(mask)
+    key_text = "\n".join(
+        _LINE_TPL.format(n=i + 1, d=q.get('difficulty', ''), q=q['question'],
+                         cl=_OPTION_LABELS[c], co=q['options'][c],
+                         ul="N/A" if u is None else _OPTION_LABELS[u], uo="" if u is None else q['options'][u],
+                         ok="✅ Correct" if ok else "❌ Wrong")
+        for i, (q, u, c, ok) in enumerate(zip(quiz_list, answers, correct, mask))
+    )
+    return {"score": score, "percentage": score / len(quiz_list) * 100, "key_text": key_text}
 
 # -----------------------
 # Streamlit UI (outline -> confirm -> generate)
 # -----------------------
-st.set_page_config(page_title="OpenAI Notes & Quiz (gpt-4o)", layout="wide")
 st.title("📘 OpenAI — In-depth Notes & Quiz (gpt-4o)")
 
 
@@ -577,6 +1175,8 @@ with st.sidebar:
     st.subheader("⚙️ Settings")
     num_images = st.slider("Number of images:", min_value=1, max_value=5, value=3)
     st.session_state['num_images'] = num_images
+    batch_mode = st.toggle("Batch mode (cheaper, slower)", help="References are queued on the OpenAI Batch API: 50% cheaper, delivered within 24 hours.")
+    st.session_state['batch_mode'] = batch_mode
     
     st.markdown("---")
     st.subheader("🛠️ Quick Tools")
@@ -588,7 +1188,7 @@ with st.sidebar:
             if image_topic.strip():
                 with st.spinner("Generating..."):
                     image_prompt = create_image_prompt_from_topic(image_topic)
-                    image_url = generate_image_with_dalle(image_prompt)
+                    image_url = run_async(generate_image_with_dalle(image_prompt))
                     if not image_url.startswith("Error"):
                         st.image(image_url, caption=f"Generated for: {image_topic}", use_column_width=True)
                         st.success("✅ Generated!")
@@ -648,45 +1248,69 @@ if 'outline' in st.session_state:
             progress_bar = st.progress(0)
             status_text = st.empty()
             
+            # Previously prepared PDFs belong to the old content
+            for name in ('notes_pdf', 'notes_pdf_future', 'quiz_pdfs', 'quiz_pdfs_future'):
+                st.session_state.pop(name, None)
+
+            # References and quiz run in the background while the notes stream in
+            batch_mode = st.session_state.get('batch_mode', False)
+            background = submit_async(generate_references_and_quiz(topic, references=not batch_mode))
+
             # Generate notes
             status_text.text("📚 Generating comprehensive notes...")
             progress_bar.progress(20)
-            notes_md = call_openai(NOTES_PROMPT, user_input=topic, temperature=0.0, max_output_tokens=6000)
+            with col_left:
+                live_notes = st.empty()
+                try:
+                    with live_notes.container():
+                        notes_md = st.write_stream(stream_openai(NOTES_PROMPT, user_input=topic, temperature=0.0, max_output_tokens=6000))
+                except Exception as exc:
+                    notes_md = f"__ERROR__:{exc}"
+                live_notes.empty()
             if notes_md.startswith("__ERROR__"):
                 st.error("❌ Error generating notes: " + notes_md)
             else:
-                st.session_state['notes_md'] = notes_md
+                put_notes(notes_md)
                 progress_bar.progress(40)
                 
             # Generate multiple images with DALL-E
             status_text.text("🖼️ Generating educational images...")
             progress_bar.progress(60)
             num_images = st.session_state.get('num_images', 3)
-            image_urls = generate_multiple_images_with_dalle(topic, num_images, notes_md[:500])
+            image_context = notes_md[:500]
+            image_urls, used_prompts = generate_multiple_images_with_dalle(topic, num_images, image_context)
             if image_urls:
                 st.session_state['generated_images'] = image_urls
-                st.session_state['image_prompts'] = [create_image_prompt_from_topic(f"Aspect {i+1} of {topic}", notes_md[:200]) for i in range(len(image_urls))]
+                st.session_state['image_prompts'] = used_prompts
                 progress_bar.progress(80)
             else:
                 st.warning("⚠️ Failed to generate images")
             
-            # Generate enhanced references
-            status_text.text("📚 Generating references...")
-            enhanced_refs = generate_enhanced_references(topic)
-            if not enhanced_refs.startswith("Error"):
+            status_text.text("📚 Finishing references and quiz...")
+            results = background.result()
+            enhanced_refs = results['references']
+            st.session_state.pop('references_batch', None)
+            if batch_mode:
+                st.session_state.pop('enhanced_references', None)
+                try:
+                    st.session_state['references_batch'] = submit_references_batch(topic)
+                    st.session_state['references_batch_topic'] = topic
+                    st.session_state['references_batch_polled'] = time.time()
+                    st.info("📬 References queued in batch mode; they will appear with the notes when ready.")
+                except Exception as e:
+                    st.warning("⚠️ Failed to queue references: " + str(e))
+            elif not enhanced_refs.startswith("__ERROR__"):
                 st.session_state['enhanced_references'] = enhanced_refs
                 progress_bar.progress(90)
             else:
                 st.warning("⚠️ Failed to generate references")
 
-            # Generate quiz
-            status_text.text("📝 Generating quiz questions...")
             progress_bar.progress(95)
             try:
-                quiz_list = generate_quiz_with_retries(topic, attempts=2)
-                st.session_state['quiz'] = quiz_list
-                st.session_state['answers'] = [None] * len(quiz_list)
-                st.session_state['show_key'] = False
+                quiz_list = results['quiz']
+                if isinstance(quiz_list, Exception):
+                    raise quiz_list
+                set_quiz(quiz_list)
                 progress_bar.progress(100)
                 status_text.text("✅ Content generation complete!")
                 st.success("🎉 All content generated successfully!")
@@ -694,7 +1318,7 @@ if 'outline' in st.session_state:
                 st.error("❌ Quiz generation failed: " + str(e))
                 st.info("🔄 Falling back to deterministic quiz...")
                 # deterministic fallback
-                base = st.session_state.get('notes_md', topic)
+                base = get_notes() if 'notes_z' in st.session_state else topic
                 lines = [ln.strip() for ln in base.splitlines() if ln.strip()]
                 fallback = []
                 for i in range(10):
@@ -703,195 +1327,221 @@ if 'outline' in st.session_state:
                     opts = [f"{snippet} (true)", "Incorrect option A", "Incorrect option B", "Incorrect option C"]
                     diff = "Easy" if i < 4 else ("Medium" if i < 7 else "Hard")
                     fallback.append({"question": qtext, "options": opts, "answer": 0, "difficulty": diff})
-                st.session_state['quiz'] = fallback
-                st.session_state['answers'] = [None]*len(fallback)
-                st.session_state['show_key'] = False
+                set_quiz(fallback)
                 progress_bar.progress(100)
                 status_text.text("✅ Content generation complete!")
                 st.success("🎉 Content generated with fallback quiz!")
 
 # Display notes & download
-if 'notes_md' in st.session_state:
+if 'notes_z' in st.session_state:
+    notes_md = get_notes()
     with col_left:
         
         st.header("📚 In-Depth Notes")
         
         # Display table of contents in an expandable section
-        toc = extract_table_of_contents(st.session_state['notes_md'])
+        toc = extract_table_of_contents(notes_md)
         if toc:
             with st.expander("📋 Table of Contents", expanded=True):
                 st.markdown(toc)
         
         # Display the full notes
-        st.markdown(st.session_state['notes_md'])
+        st.markdown(notes_md)
         
         # Display generated images if available
         if 'generated_images' in st.session_state and st.session_state['generated_images']:
             st.subheader("🖼️ Generated Educational Images")
-            
-            # Display images in a grid
-            images = st.session_state['generated_images']
-            cols = st.columns(min(len(images), 3))  # Max 3 columns
-            
-            for i, image_url in enumerate(images):
-                with cols[i % 3]:
-                    st.image(image_url, caption=f"Educational illustration {i+1}", use_column_width=True)
-            
-            # Show the prompts used for image generation
-            with st.expander("View image generation prompts"):
-                prompts = st.session_state.get('image_prompts', [])
-                for i, prompt in enumerate(prompts):
-                    st.text(f"Image {i+1}: {prompt}")
+            # filled in after the regenerate button, so new images show without a second run
+            gallery = st.container()
                 
             # Option to regenerate all images
             if st.button("🔄 Regenerate All Images"):
                 with st.spinner("Generating new images..."):
                     num_images = st.session_state.get('num_images', 3)
-                    new_image_urls = generate_multiple_images_with_dalle(topic, num_images, st.session_state.get('notes_md', '')[:500])
+                    new_image_urls, used_prompts = generate_multiple_images_with_dalle(topic, num_images, notes_md[:500], refresh=True)
                     if new_image_urls:
                         st.session_state['generated_images'] = new_image_urls
+                        st.session_state.pop('notes_pdf', None)
+                        st.session_state.pop('notes_pdf_future', None)
+                        st.session_state['image_prompts'] = used_prompts
                         st.success(f"Generated {len(new_image_urls)} new images!")
-                        st.rerun()
                     else:
                         st.error("Failed to regenerate images.")
+
+            with gallery:
+                # Display images in a grid
+                images = st.session_state['generated_images']
+                cols = st.columns(min(len(images), 3))  # Max 3 columns
+                
+                for i, image_url in enumerate(images):
+                    with cols[i % 3]:
+                        st.image(image_url, caption=f"Educational illustration {i+1}", use_column_width=True)
+                
+                # Show the prompts used for image generation
+                with st.expander("View image generation prompts"):
+                    prompts = st.session_state.get('image_prompts', [])
+                    for i, prompt in enumerate(prompts):
+                        st.text(f"Image {i+1}: {prompt}")
         
         
+        # References queued in batch mode: check on the batch at most every BATCH_POLL_INTERVAL seconds
+        batch_id = st.session_state.get('references_batch')
+        if batch_id and time.time() - st.session_state.get('references_batch_polled', 0) >= BATCH_POLL_INTERVAL:
+            st.session_state['references_batch_polled'] = time.time()
+            try:
+                batch_refs = poll_references_batch(batch_id, st.session_state.get('references_batch_topic', topic))
+            except Exception as e:
+                batch_refs = f"__ERROR__:{e}"
+            if batch_refs is not None:
+                del st.session_state['references_batch']
+                if batch_refs.startswith("__ERROR__"):
+                    st.warning("⚠️ Batch references failed: " + batch_refs)
+                else:
+                    st.session_state['enhanced_references'] = batch_refs
+        if 'references_batch' in st.session_state:
+            st.subheader("📚 Enhanced References & Resources")
+            st.info("⏳ References are being generated by the Batch API (up to 24 hours). They will show up here once ready.")
+
         # Display enhanced references if available
         if 'enhanced_references' in st.session_state and st.session_state['enhanced_references']:
             st.subheader("📚 Enhanced References & Resources")
-            st.markdown(st.session_state['enhanced_references'])
+            references_slot = st.empty()
             
             # Option to regenerate references
             if st.button("🔄 Regenerate References"):
                 with st.spinner("Generating new references..."):
-                    new_refs = generate_enhanced_references(topic)
+                    new_refs = generate_enhanced_references(topic, refresh=True)
                     if not new_refs.startswith("Error"):
                         st.session_state['enhanced_references'] = new_refs
                         st.success("New references generated!")
-                        st.rerun()
                     else:
                         st.error("Failed to regenerate references.")
-        # build PDF bytes (transliteration inside function)
-        notes_pdf = markdown_to_pdf_bytes(st.session_state['notes_md'], title=f"Notes: {topic}")
-        st.download_button("📥 Download Notes (PDF)", notes_pdf, file_name="notes.pdf", mime="application/pdf")
+            references_slot.markdown(st.session_state['enhanced_references'])
+        # PDF is only built on request, not on every rerun, from the notes' stored ASCII copy;
+        # generated images are embedded
+        if st.button("📄 Prepare Notes PDF"):
+            st.session_state.pop('notes_pdf', None)
+            st.session_state['notes_pdf_future'] = pdf_executor.submit(notes_pdf, get_notes_ascii(), f"Notes: {topic}", tuple(st.session_state.get('generated_images') or ()))
+        if collect_pdf('notes_pdf'):
+            st.caption("⏳ Building PDF...")
+        elif 'notes_pdf' in st.session_state:
+            if not pdf_download_button("📥 Download Notes (PDF)", st.session_state['notes_pdf'], "notes.pdf"):
+                del st.session_state['notes_pdf']
+                st.caption("The prepared PDF has expired; prepare it again.")
 
 # Display quiz & interactions
 if 'quiz' in st.session_state:
-    quiz = st.session_state['quiz']
+    # session state is read into locals once per run; flags are updated alongside their locals
+    ss = st.session_state
+    quiz = ss['quiz']
+    answers = ss['answers']
+    quiz_submitted = ss.get('quiz_submitted', False)
+    show_key = ss.get('show_key', False)
     with col_right:
         st.header("📝 Quiz (10 Questions)")
-        order = ["Easy", "Medium", "Hard"]
-        grouped = {k: [] for k in order}
-        for idx, q in enumerate(quiz):
-            diff = q.get('difficulty', 'Medium')
-            grouped.setdefault(diff, []).append(idx)
-
-        answers = st.session_state.get('answers', [None]*len(quiz))
-        progress = int((sum(1 for a in answers if a is not None) / len(quiz)) * 100) if len(quiz) else 0
-        st.progress(progress)
-
-        for diff in order:
-            idxs = grouped.get(diff, [])
-            if not idxs:
-                continue
-            with st.expander(f"{diff} — {len(idxs)} Qs", expanded=(diff == "Easy")):
-                for idx in idxs:
-                    q = quiz[idx]
-                    st.markdown(f"**Q{idx+1}.** {q['question']}")
-                    opts_with_placeholder = ["— Select an option —"] + q['options']
-                    key = f"q_{idx}"
-                    prev = st.session_state['answers'][idx]
-                    default_index = (prev + 1) if prev is not None else 0
-                    if default_index < 0 or default_index >= len(opts_with_placeholder):
-                        default_index = 0
-                    selected = st.radio("Select your answer:", opts_with_placeholder, key=key, index=default_index, label_visibility="collapsed")
-                    if selected == "— Select an option —":
-                        st.session_state['answers'][idx] = None
-                    else:
-                        try:
-                            sel_idx = q['options'].index(selected)
-                        except ValueError:
-                            sel_idx = opts_with_placeholder.index(selected) - 1
-                        st.session_state['answers'][idx] = int(sel_idx)
-                    st.markdown("---")
-
-        # Submit button and answer key access
+        grouped = ss['quiz_grouped']
+        progress_slot = st.empty()
+
+        # Only the chosen difficulty's questions are rendered; answers from the other groups
+        # are kept in st.session_state['answers'], not in their (unrendered) widgets
+        diff = ss['active_diff']
+
+        # Selections only reach the script when the form is submitted, not on every click;
+        # the difficulty buttons submit it too, so switching saves the shown selections
+        with st.form("quiz_form"):
+            diffs = [d for d in QUIZ_ORDER if grouped[d]]
+            for d, col in zip(diffs, st.columns(len(diffs) or 1)):
+                col.form_submit_button(f"{d} — {len(grouped[d])} Qs", disabled=d == diff,
+                                       on_click=switch_difficulty, args=(d,))
+            selections = {}
+            for idx in grouped[diff]:
+                q = quiz[idx]
+                prev = answers[idx]
+                # the question is the radio's own label: one element instead of a separate markdown
+                selected = st.radio(f"**Q{idx+1}.** {q['question']}", q['_opts_pl'], key=f"q_{idx}", index=0 if prev is None else prev + 1)
+                # the placeholder is not an option, so it maps to None (unanswered)
+                selections[idx] = q['_opt_idx'].get(selected)
+                st.markdown("---")
+            submitted = st.form_submit_button("📝 Submit Quiz", type="primary")
+
+        # answered_count tracks the non-None answers, so progress never rescans the list
+        answered_count = ss['answered_count']
+        if submitted:
+            for idx, sel_idx in selections.items():
+                answered_count += (sel_idx is not None) - (answers[idx] is not None)
+                answers[idx] = sel_idx
+            ss['answered_count'] = answered_count
+            ss.pop('quiz_result', None)
+        all_ans = answered_count == len(quiz)
+        progress_slot.progress(int(100 * answered_count / len(quiz)) if quiz else 0)
+
+        # Submit result and answer key access
         col1, col2 = st.columns([1, 1])
         
         with col1:
-            all_ans = all(a is not None for a in st.session_state.get('answers', []))
-            if not all_ans:
-                st.warning("Answer all questions to submit the quiz.")
-                submit_disabled = True
-            else:
-                submit_disabled = False
-                
-            if st.button("📝 Submit Quiz", disabled=submit_disabled, type="primary"):
-                st.session_state['quiz_submitted'] = True
-                st.session_state['show_key'] = True
-                st.success("Quiz submitted! Check your results below.")
-                st.rerun()
+            if submitted:
+                if all_ans:
+                    ss['quiz_submitted'] = quiz_submitted = True
+                    ss['show_key'] = show_key = True
+                    st.success("Quiz submitted! Check your results below.")
+                else:
+                    st.warning("Answers saved. Answer all questions (in every difficulty) to submit the quiz.")
         
         with col2:
             if st.button("🔍 View Answer Key", help="View answers without submitting"):
-                st.session_state['show_key'] = True
+                ss['show_key'] = show_key = True
                 st.info("Answer key revealed. Your answers are not submitted.")
         
         # Reset quiz option
-        if st.session_state.get('quiz_submitted', False) or st.session_state.get('show_key', False):
-            if st.button("🔄 Reset Quiz", help="Start the quiz over"):
-                # Reset quiz state
-                st.session_state['answers'] = [None] * len(quiz)
-                st.session_state['show_key'] = False
-                st.session_state['quiz_submitted'] = False
-                st.success("Quiz reset! You can now take it again.")
-                st.rerun()
-
-        if st.session_state.get('show_key'):
-            answers = st.session_state['answers']
-            score = 0
-            lines = []
-            
-            # Calculate score and prepare results
-            for i, q in enumerate(quiz):
-                user_idx = answers[i]
-                correct_idx = q['answer']
-                if user_idx == correct_idx:
-                    score += 1
-                user_label = chr(65 + user_idx) if user_idx is not None else "N/A"
-                correct_label = chr(65 + correct_idx)
-                lines.append(f"Q{i+1}. ({q.get('difficulty','')}) {q['question']}\nCorrect: {correct_label}) {q['options'][correct_idx]}\nYour answer: {user_label}) {q['options'][user_idx] if user_idx is not None else ''}\n{'✅ Correct' if user_idx==correct_idx else '❌ Wrong'}\n")
-            
+        if quiz_submitted or show_key:
+            # state is reset in the callback, before this run renders the quiz
+            st.button("🔄 Reset Quiz", help="Start the quiz over", on_click=reset_quiz)
+
+        if show_key:
+            # Scored once per set of submitted answers, not on every rerun
+            result = ss.get('quiz_result')
+            if result is None:
+                result = ss['quiz_result'] = score_quiz(quiz, answers, ss['quiz_correct'])
+            score = result['score']
+
             # Display results with submission status
-            percentage = score/len(quiz)*100
-            if st.session_state.get('quiz_submitted', False):
-                st.subheader(f"📊 Quiz Results: {score}/{len(quiz)} ({percentage:.1f}%)")
-                st.success("🎉 Quiz submitted successfully!")
+            percentage = result['percentage']
+            # heading and status box are sent as one element
+            if quiz_submitted:
+                heading, note, color = "Quiz Results", "🎉 Quiz submitted successfully!", "#d4edda"
             else:
-                st.subheader(f"📊 Answer Key Preview: {score}/{len(quiz)} ({percentage:.1f}%)")
-                st.info("💡 This is a preview. Submit the quiz to record your score.")
+                heading, note, color = "Answer Key Preview", "💡 This is a preview. Submit the quiz to record your score.", "#d1ecf1"
+            st.markdown(f"<h3>📊 {heading}: {score}/{len(quiz)} ({percentage:.1f}%)</h3>"
+                        f"<div style='padding:8px;border-radius:6px;background:{color};color:#1e1e1e'>{note}</div>",
+                        unsafe_allow_html=True)
             
             # Performance feedback
-            if percentage >= 90:
-                st.success("🌟 Excellent work! You've mastered this topic!")
-            elif percentage >= 80:
-                st.success("👍 Great job! You have a solid understanding.")
-            elif percentage >= 70:
-                st.warning("📚 Good effort! Review the incorrect answers to improve.")
-            elif percentage >= 60:
-                st.warning("📖 Keep studying! Focus on the areas you missed.")
-            else:
-                st.error("📚 More study needed. Review the material and try again.")
+            feedback, message = _FEEDBACK[min(int(percentage) // 10, 10)]
+            feedback(message)
             
             st.subheader("🔑 Detailed Answer Key")
-            for block in lines:
-                st.code(block)
+            st.code(result['key_text'])
 
             # downloads
             st.subheader("📥 Downloads")
-            quiz_pdf = quiz_pdf_bytes(quiz, title=f"Quiz: {topic}")
-            ans_pdf = answer_key_pdf_bytes(quiz, title=f"Answer Key: {topic}")
-            st.download_button("📥 Download Quiz (PDF)", quiz_pdf, file_name="quiz.pdf", mime="application/pdf")
-            st.download_button("📥 Download Answer Key (PDF)", ans_pdf, file_name="answer_key.pdf", mime="application/pdf")
+            if st.button("📄 Prepare Quiz PDFs"):
+                ss.pop('quiz_pdfs', None)
+                ss['quiz_pdfs_future'] = pdf_executor.submit(quiz_pdfs, quiz, topic)
+            if collect_pdf('quiz_pdfs'):
+                st.caption("⏳ Building PDFs...")
+            elif 'quiz_pdfs' in ss:
+                quiz_path, ans_path = ss['quiz_pdfs']
+                if not (pdf_download_button("📥 Download Quiz (PDF)", quiz_path, "quiz.pdf")
+                        and pdf_download_button("📥 Download Answer Key (PDF)", ans_path, "answer_key.pdf")):
+                    del ss['quiz_pdfs']
+                    st.caption("The prepared PDFs have expired; prepare them again.")
 
 st.caption("If parsing sometimes fails, press Confirm → Generate again. We try a second parsing attempt automatically before falling back.")
+
+# The rest of the page is already on screen; wait for any PDF still building, then rerun to offer it.
+# Builds whose section was not rendered this run (e.g. the quiz was reset) are collected here too,
+# so a finished future never triggers another rerun.
+pending = [st.session_state[f"{name}_future"] for name in ('notes_pdf', 'quiz_pdfs') if collect_pdf(name)]
+if pending:
+    concurrent.futures.wait(pending)
+    st.rerun()